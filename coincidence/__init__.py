@@ -1,4 +1,6 @@
 """ Coincidence package
 """
 
-from .coincidence import link_table, jaccard_table, calc_ratios
+from .coincidence import (link_table, jaccard_table, jaccard_table_u8,
+                          link_pairs, jaccard_pairs, build_pair_vectors,
+                          calc_ratios, count_ratios)
@@ -1,8 +1,34 @@
 """ Series ids and Jaccard coefficients
 """
 
+from functools import lru_cache
+
 import numpy as np
 
+try:
+    from numba import njit, prange
+except ImportError:
+    _HAVE_NUMBA = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        return lambda func: func
+else:
+    _HAVE_NUMBA = True
+
+
+def _as_ids(series_ids):
+    """ Return `series_ids` as array, and whether it can contain NaN
+
+    Integer (and bool) ids cannot be NaN, and are returned as they are, so
+    that large integers compare exactly.  Other ids are converted to float.
+    """
+    series_ids = np.asarray(series_ids)
+    can_nan = series_ids.dtype.kind not in 'biu'
+    if can_nan:
+        series_ids = np.asarray(series_ids, dtype=float)
+    return series_ids, can_nan
+
 
 def link_table(series_ids):
     """ Make shape (n, n) array `arr` of link dummy indicators
@@ -13,141 +39,278 @@ def link_table(series_ids):
 
     A 1 in ``arr[i, j]`` means that case ``i`` has a link to case ``j``.
     """
-    series_ids = np.array(series_ids, dtype=float)
+    series_ids, can_nan = _as_ids(series_ids)
+    is_nan = None
+    if can_nan:
+        is_nan = np.isnan(series_ids)
+        if not np.any(is_nan):
+            is_nan = None
+        # Compare the smallest possible integer labels rather than floats.
+        labels = np.unique(series_ids, return_inverse=True)[1]
+        series_ids = labels.astype(np.min_scalar_type(len(labels)))
     n = len(series_ids)
-    arr = np.zeros((n, n))
+    arr = np.empty((n, n))
     col, row = series_ids[:, None], series_ids[None, :]
-    arr[:, :] = col == row
-    arr[np.isnan(col + row)] = np.nan
+    # Write 0., 1. directly, without a bool temporary.
+    np.equal(col, row, out=arr, casting='unsafe')
+    if is_nan is not None:
+        # Bool (not float) mask for where either value is NaN.
+        nan_col = is_nan[:, None]
+        np.copyto(arr, np.nan, where=nan_col | nan_col.T)
     return arr
 
 
-def jaccard_table(col):
+def jaccard_table(col, out=None):
     """ Make shape (n, n) array `arr` of 1, 1 coincidences in `col`.
 
     A 1 in ``arr[i, j]`` means that both case ``i`` and ``j`` have a 1 in the
     corresponding position in `col`.
 
-    See :func:`jaccard_table_slow` for a version that might be easier to read.
+    `out` is an optional shape (n, n) array in which to place the result.
+    For example, pass a float32 array to halve memory use.
     """
-    col = np.array(col, dtype=float)[:, None]  # Row
-    res = col * col.T
+    col = np.asarray(col, dtype=float)
+    res = np.multiply.outer(col, col, out=out)
     # If either value is 0, 0 overrides nan
     is_zero = col == 0
-    res[is_zero | is_zero.T] = 0
+    np.copyto(res, 0, where=np.logical_or.outer(is_zero, is_zero))
+    return res
+
+
+def jaccard_table_u8(col):
+    """ Make shape (n, n) uint8 array `arr` of 1, 1 coincidences in `col`.
+
+    As for :func:`jaccard_table`, but `col` must be binary (only 0 and 1,
+    no NaN), so the result fits in one byte per case pair.
+    """
+    col = _as_binary(col)
+    return np.bitwise_and.outer(col, col)
+
+
+def _pair_pos(i, j):
+    """ Position of pair (`i`, `j`), ``i > j``, in unravelled lower triangle
+    """
+    return i * (i - 1) // 2 + j
+
+
+# Largest n for which to cache tril indices.  Larger index arrays would
+# hold a lot of memory in the cache for the life of the process.
+_TRIL_CACHE_MAX = 128
+
+
+def _tril_idx(n):
+    """ ``np.tril_indices(n, -1)``, cached (read-only) for small `n`
+    """
+    if n <= _TRIL_CACHE_MAX:
+        return _cached_tril_idx(n)
+    return np.tril_indices(n, -1)
+
+
+@lru_cache(maxsize=32)
+def _cached_tril_idx(n):
+    inds = np.tril_indices(n, -1)
+    for ind in inds:
+        ind.flags.writeable = False
+    return inds
+
+
+def link_pairs(series_ids):
+    """ Make 1D array of link dummy indicators for unique pairs of cases
+
+    Returns the same values as the lower triangle (below the diagonal) of
+    ``link_table(series_ids)``, unravelled in row-major order, without
+    building the full (n, n) table.
+    """
+    series_ids, can_nan = _as_ids(series_ids)
+    n = len(series_ids)
+    res = np.zeros(_n_pairs(n))
+    # Sort cases by series; each series is then a contiguous run of cases.
+    order = np.argsort(series_ids, kind='stable')
+    ids, starts = np.unique(series_ids[order], return_index=True)
+    stops = np.append(starts[1:], n)
+    for series_id, start, stop in zip(ids, starts, stops):
+        if stop - start < 2 or (can_nan and np.isnan(series_id)):
+            continue
+        # Cases in series, in ascending order, thanks to the stable sort.
+        members = order[start:stop]
+        a, b = _tril_idx(len(members))
+        rows, cols = members[a], members[b]
+        res[_pair_pos(rows, cols)] = 1
+    if not can_nan:
+        return res
+    # Set pairs including a case with NaN series id to NaN.
+    for k in np.flatnonzero(np.isnan(series_ids)):
+        # Pairs (k, j) for j < k are contiguous.
+        start = _pair_pos(k, 0)
+        res[start:start + k] = np.nan
+        rows = np.arange(k + 1, n)
+        res[_pair_pos(rows, k)] = np.nan
     return res
 
 
+# Smallest n for which to use the numba kernel in jaccard_pairs.  Below this,
+# NumPy is quick enough, and we avoid paying for JIT compilation.
+_JIT_MIN_N = 1000
+
+
+def jaccard_pairs(col):
+    """ Make 1D array of 1, 1 coincidences for unique pairs of cases in `col`
+
+    Returns the same values as the lower triangle (below the diagonal) of
+    ``jaccard_table(col)``, unravelled in row-major order, without building
+    the full (n, n) table.
+    """
+    col = np.asarray(col, dtype=float)
+    if _HAVE_NUMBA and len(col) >= _JIT_MIN_N:
+        res = np.empty(_n_pairs(len(col)))
+        _jaccard_pairs_kernel(col, res)
+        return res
+    i, j = _tril_idx(len(col))
+    col, row = col[i], col[j]
+    res = col * row
+    # If either value is 0, 0 overrides nan
+    res[(col == 0) | (row == 0)] = 0
+    return res
+
+
+@njit(parallel=True, cache=True)
+def _jaccard_pairs_kernel(col, res):
+    # Pairs for case i are contiguous in `res`, so each row is one
+    # sequential read of col[:i], and one sequential write.
+    for i in prange(1, len(col)):
+        a = col[i]
+        start = i * (i - 1) // 2
+        for j in range(i):
+            b = col[j]
+            # If either value is 0, 0 overrides nan
+            if a == 0.0 or b == 0.0:
+                res[start + j] = 0.0
+            else:
+                res[start + j] = a * b
+
+
+def build_pair_vectors(series_ids, feature):
+    """ Make 1D link, Jaccard and NaN arrays for unique pairs of cases
+
+    Returns ``(link_pairs(series_ids), jaccard_pairs(feature), is_nan)``,
+    where ``is_nan`` is True for pairs where either the link or the Jaccard
+    value is NaN; :func:`calc_ratios` drops these pairs.  The arrays are
+    parallel, with one element per unique pair, and no (n, n) table is
+    built on the way.
+    """
+    if len(series_ids) != len(feature):
+        raise ValueError('series_ids and feature should be the same length')
+    links = link_pairs(series_ids)
+    jaccs = jaccard_pairs(feature)
+    is_nan = np.isnan(links)
+    np.logical_or(is_nan, np.isnan(jaccs), out=is_nan)
+    return links, jaccs, is_nan
+
+
+def _as_binary(col):
+    col = np.asarray(col)
+    if not np.all((col == 0) | (col == 1)):
+        raise ValueError('Values should only be 0 or 1')
+    return col.astype(np.uint8)
+
+
+def _n_pairs(n):
+    return n * (n - 1) // 2
+
+
+def count_ratios(series_ids, feature):
+    """ Calculate ratios as for :func:`calc_ratios` from counts of cases
+
+    Gives the same answer as ``calc_ratios(link_pairs(series_ids),
+    jaccard_pairs(feature))``, but never builds the pair vectors.  Instead,
+    count pairs from the number of 1 and NaN values in `feature`, overall
+    and within each series.
+    """
+    if len(series_ids) != len(feature):
+        raise ValueError('series_ids and feature should be the same length')
+    series_ids, can_nan = _as_ids(series_ids)
+    feature = np.asarray(feature, dtype=float)
+    if can_nan:
+        # Pairs with a NaN series id drop out of the ratios; drop these
+        # cases.
+        known = ~np.isnan(series_ids)
+        series_ids, feature = series_ids[known], feature[known]
+    is_one, is_nan = feature == 1, np.isnan(feature)
+    if not np.all(is_one | is_nan | (feature == 0)):
+        raise ValueError('feature should only contain 0, 1 or NaN')
+    # Counts of cases, 1s and NaNs in each series.
+    _, labels = np.unique(series_ids, return_inverse=True)
+    n_series = labels.max(initial=-1) + 1
+    g_cases = np.bincount(labels, minlength=n_series)
+    g_ones = np.bincount(labels[is_one], minlength=n_series)
+    g_nans = np.bincount(labels[is_nan], minlength=n_series)
+    n_ones, n_nans = g_ones.sum(), g_nans.sum()
+    # Jaccard pairs are NaN, and drop out, where neither value is 0, and at
+    # least one value is NaN.
+    n_dropped = _n_pairs(n_ones + n_nans) - _n_pairs(n_ones)
+    g_dropped = _n_pairs(g_ones + g_nans) - _n_pairs(g_ones)
+    n_pairs = _n_pairs(len(series_ids)) - n_dropped
+    n_links = np.sum(_n_pairs(g_cases) - g_dropped)
+    n_jaccs = _n_pairs(n_ones)
+    n_jl = np.sum(_n_pairs(g_ones))
+    return _ratios(n_links, n_jaccs, n_jl, n_pairs)
+
+
 def calc_ratios(link_pairs, jacc_pairs):
-    not_nan = ~np.isnan(link_pairs + jacc_pairs)
-    link_pairs, jacc_pairs = link_pairs[not_nan], jacc_pairs[not_nan]
-    n_links = np.sum(link_pairs)
-    n_jaccs = np.sum(jacc_pairs)
-    # Multiply the links and Jaccards, and sum them to get the number
-    # of links that are also Jaccards.
-    n_jl = np.sum(link_pairs * jacc_pairs)
+    link_pairs, jacc_pairs = np.asarray(link_pairs), np.asarray(jacc_pairs)
+    if link_pairs.dtype.kind in 'biu' and jacc_pairs.dtype.kind in 'biu':
+        # Integer (e.g. uint8) 0, 1 values cannot be NaN, and take less
+        # memory to count than floats.
+        counts = _int_counts(link_pairs, jacc_pairs)
+    elif _HAVE_NUMBA:
+        counts = _nan_counts_kernel(link_pairs, jacc_pairs)
+    else:
+        counts = _nan_counts(link_pairs, jacc_pairs)
+    return _ratios(*counts)
+
+
+def _ratios(n_links, n_jaccs, n_jl, n_pairs):
     # Linked Jaccards divided by all links.
-    jl_rat = n_jl / n_links
+    jl_rat = np.float64(n_jl) / n_links
     # Non-linked Jaccards divided by all non-links.
-    jnl_rat = (n_jaccs - n_jl) / (len(link_pairs) - n_links)
+    jnl_rat = np.float64(n_jaccs - n_jl) / (n_pairs - n_links)
     return jl_rat, jnl_rat
 
 
-def test_jaccard():
-    # Case links
-    in_col = [0, 1, 1, 2, 3, 3, 3, 4]
-    # Presence of feature
-    feature = [0, 0, 1, 0, 1, 1, 1, 0]
-    link_arr = link_table(in_col)
-    assert np.all(link_arr == equal_to(in_col))
-    # Extract lower triangle, and unravel to 1D.
-    inds = np.tril_indices(8, -1)
-    link_pairs = link_arr[inds]
-    assert np.all(link_pairs ==
-                  [0,
-                   0, 1,
-                   0, 0, 0,
-                   0, 0, 0, 0,
-                   0, 0, 0, 0, 1,
-                   0, 0, 0, 0, 1, 1,
-                   0, 0, 0, 0, 0, 0, 0])
-    jacc_pairs = jaccard_table(feature)[inds]
-    assert np.all(jacc_pairs ==
-                  [0,
-                   0, 0,
-                   0, 0, 0,
-                   0, 0, 1, 0,
-                   0, 0, 1, 0, 1,
-                   0, 0, 1, 0, 1, 1,
-                   0, 0, 0, 0, 0, 0, 0])
-    # Check slow version gives same answer.
-    assert np.all(jacc_pairs == both_1(feature)[inds])
-    jl_r, jnl_r = calc_ratios(link_pairs, jacc_pairs)
-    assert np.isclose(jl_r, 3 / 4)
-    assert np.isclose(jnl_r, 3 / 24)
-
-
-def nan_eq(a, b):
-    return np.array_equal(a, b, equal_nan=True)
-
-
-def test_jaccard_nan():
-    # Case links
-    in_col = [0, 1, 1, 2, 3, np.nan, 3, 4]
-    # Presence of feature
-    feature = [0, np.nan, 1, 0, 1, np.nan, 1, 0]
-    link_arr = link_table(in_col)
-    assert nan_eq(link_arr, equal_to(in_col))
-    # Extract lower triangle, and unravel to 1D.
-    inds = np.tril_indices(8, -1)
-    link_pairs = link_arr[inds]
-    assert nan_eq(link_pairs,
-                  [0,
-                   0, 1,
-                   0, 0, 0,
-                   0, 0, 0, 0,
-                   np.nan, np.nan, np.nan, np.nan, np.nan,
-                   0, 0, 0, 0, 1, np.nan,
-                   0, 0, 0, 0, 0, np.nan, 0])
-    jacc_pairs = jaccard_table(feature)[inds]
-    # Check slow version gives same answer.
-    assert nan_eq(jacc_pairs, both_1(feature)[inds])
-    assert nan_eq(jacc_pairs,
-                  [0,
-                   0, np.nan,
-                   0, 0, 0,
-                   0, np.nan, 1, 0,
-                   0, np.nan, np.nan, 0, np.nan,
-                   0, np.nan, 1, 0, 1, np.nan,
-                   0, 0, 0, 0, 0, 0, 0])
-    jl_r, jnl_r = calc_ratios(link_pairs, jacc_pairs)
-    assert np.isclose(jl_r, 1)
-    assert np.isclose(jnl_r, 2 / 17)
-
-
-def test_jaccard2():
-    # Case links (case IDs)
-    in_col = [0, 0, 0, 1, 2]
-    # Presence of feature
-    feature = [1, 1, 0, 0, 1]
-    link_arr = link_table(in_col)
-    assert np.all(link_arr == equal_to(in_col))
-    # Extract lower triangle, and unravel to 1D.
-    inds = np.tril_indices(5, -1)
-    link_pairs = link_arr[inds]
-    assert np.all(link_pairs ==
-                  [1,
-                   1, 1,
-                   0, 0, 0,
-                   0, 0, 0, 0])
-    jacc_pairs = jaccard_table(feature)[inds]
-    assert np.all(jacc_pairs ==
-                  [1,
-                   0, 0,
-                   0, 0, 0,
-                   1, 1, 0, 0])
-    # Check slow version gives same answer.
-    assert np.all(jacc_pairs == both_1(feature)[inds])
-    jl_r, jnl_r = calc_ratios(link_pairs, jacc_pairs)
-    assert np.isclose(jl_r, 1 / 3)
-    assert np.isclose(jnl_r, 2 / 7)
+def _int_counts(link_pairs, jacc_pairs):
+    n_links = np.count_nonzero(link_pairs)
+    n_jaccs = np.count_nonzero(jacc_pairs)
+    n_jl = np.count_nonzero(np.logical_and(link_pairs, jacc_pairs))
+    return n_links, n_jaccs, n_jl, len(link_pairs)
+
+
+def _nan_counts(link_pairs, jacc_pairs):
+    # Drop pairs where either value is NaN, without a float temporary, and
+    # without a copy if there are no NaNs.
+    is_nan = np.isnan(link_pairs)
+    np.logical_or(is_nan, np.isnan(jacc_pairs), out=is_nan)
+    if np.any(is_nan):
+        not_nan = ~is_nan
+        link_pairs, jacc_pairs = link_pairs[not_nan], jacc_pairs[not_nan]
+    n_links = np.sum(link_pairs)
+    n_jaccs = np.sum(jacc_pairs)
+    # The dot product of the links and Jaccards is the number of links
+    # that are also Jaccards.
+    n_jl = np.dot(link_pairs, jacc_pairs)
+    return n_links, n_jaccs, n_jl, len(link_pairs)
+
+
+@njit(cache=True)
+def _nan_counts_kernel(link_pairs, jacc_pairs):
+    # As for _nan_counts, in one pass, without temporary arrays.
+    n_links = n_jaccs = n_jl = 0.0
+    n_pairs = 0
+    for i in range(len(link_pairs)):
+        a, b = link_pairs[i], jacc_pairs[i]
+        if a != a or b != b:  # NaN
+            continue
+        n_pairs += 1
+        n_links += a
+        n_jaccs += b
+        n_jl += a * b
+    return n_links, n_jaccs, n_jl, n_pairs
@@ -1,42 +1,72 @@
 """ Tests for cooincidnce functions
 """
 
+from array import array
+
 import numpy as np
 
-from coincidence import link_table, jaccard_table, calc_ratios
+from coincidence import (link_table, jaccard_table, jaccard_table_u8,
+                         link_pairs, jaccard_pairs, build_pair_vectors,
+                         calc_ratios, count_ratios)
+from coincidence.coincidence import (_jaccard_pairs_kernel, _nan_counts,
+                                     _nan_counts_kernel, njit, prange,
+                                     _HAVE_NUMBA)
+
+import pytest
+
+
+def _run_slow(kernel, col):
+    # Run slow `kernel` on `col`, filling a flat (n * n) output buffer.
+    col = np.asarray(col, dtype=float)
+    n = len(col)
+    if _HAVE_NUMBA:
+        buf = np.zeros(n * n)
+        kernel(col, buf)
+        return buf.reshape((n, n))
+    # Python floats and array.array avoid the per-element overhead of
+    # indexing into NumPy arrays.
+    buf = array('d', bytes(8 * n * n))
+    kernel(col.tolist(), buf)
+    return np.frombuffer(buf).reshape((n, n))
 
 
 def equal_to(col):
     # Slow version for link_table calculation
-    col = np.array(col, dtype=float)
+    return _run_slow(_equal_to, col)
+
+
+@njit(parallel=True)
+def _equal_to(col, arr):
     n = len(col)
-    arr = np.zeros((n, n))
-    for i in range(n):
+    for i in prange(n):
+        a = col[i]
         for j in range(n):
-            a, b = col[i], col[j]
-            if np.isnan(a) or np.isnan(b):
-                arr[i, j] = np.nan
-            else:
-                arr[i, j] = a == b
-    return arr
+            b = col[j]
+            if a != a or b != b:  # NaN
+                arr[i * n + j] = np.nan
+            elif a == b:
+                arr[i * n + j] = 1
 
 
 def both_1(col):
     # Slow version for jaccard_table calculation
     # Slow calculation for illustration.
-    col = np.array(col, dtype=float)
+    return _run_slow(_both_1, col)
+
+
+@njit(parallel=True)
+def _both_1(col, arr):
     n = len(col)
-    arr = np.zeros((n, n))
-    for i in range(n):
+    for i in prange(n):
+        a = col[i]
         for j in range(n):
-            a, b = col[i], col[j]
-            if 0 in (a, b):
-                arr[i, j] = 0
-            elif np.isnan(a + b):
-                arr[i, j] = np.nan
+            b = col[j]
+            if a == 0.0 or b == 0.0:
+                arr[i * n + j] = 0
+            elif a != a or b != b:  # NaN
+                arr[i * n + j] = np.nan
             else:
-                arr[i, j] = 1
-    return arr
+                arr[i * n + j] = 1
 
 
 def test_jaccard():
@@ -137,3 +167,148 @@ def test_jaccard2():
     jl_r, jnl_r = calc_ratios(link_pairs, jacc_pairs)
     assert np.isclose(jl_r, 1 / 3)
     assert np.isclose(jnl_r, 2 / 7)
+
+
+# Series ids, features for pair tests.
+PAIR_CASES = (
+    ([0, 1, 1, 2, 3, 3, 3, 4], [0, 0, 1, 0, 1, 1, 1, 0]),
+    ([0, 1, 1, 2, 3, np.nan, 3, 4], [0, np.nan, 1, 0, 1, np.nan, 1, 0]),
+    ([0, 0, 0, 1, 2], [1, 1, 0, 0, 1]),
+    ([2, np.nan, 0, 2, 0, np.nan, 2], [1, 0, 1, 1, 0, 1, 1]))
+
+
+def test_pairs():
+    for in_col, feature in PAIR_CASES:
+        inds = np.tril_indices(len(in_col), -1)
+        lp = link_pairs(in_col)
+        assert nan_eq(lp, link_table(in_col)[inds])
+        jp = jaccard_pairs(feature)
+        assert nan_eq(jp, jaccard_table(feature)[inds])
+        assert np.allclose(calc_ratios(lp, jp),
+                           calc_ratios(link_table(in_col)[inds],
+                                       jaccard_table(feature)[inds]))
+
+
+def test_kernels():
+    # Kernels run compiled with numba, or as Python otherwise.
+    for in_col, feature in PAIR_CASES:
+        lp, jp = link_pairs(in_col), jaccard_pairs(feature)
+        res = np.empty(len(jp))
+        _jaccard_pairs_kernel(np.array(feature, dtype=float), res)
+        assert nan_eq(res, jp)
+        assert np.allclose(_nan_counts_kernel(lp, jp), _nan_counts(lp, jp))
+
+
+def test_calc_ratios_int():
+    for in_col, feature in PAIR_CASES:
+        lp, jp = link_pairs(in_col), jaccard_pairs(feature)
+        if np.any(np.isnan(lp) | np.isnan(jp)):
+            continue
+        assert np.allclose(calc_ratios(lp.astype(np.uint8),
+                                       jp.astype(np.uint8)),
+                           calc_ratios(lp, jp))
+        assert np.allclose(calc_ratios(lp.astype(bool), jp.astype(bool)),
+                           calc_ratios(lp, jp))
+    # Mixed signed and unsigned integers.
+    assert np.allclose(calc_ratios(np.array([1, 0, 1], np.int64),
+                                   np.array([1, 1, 0], np.uint64)),
+                       (0.5, 1.0))
+
+
+def test_build_pair_vectors():
+    for in_col, feature in PAIR_CASES:
+        lp, jp = link_pairs(in_col), jaccard_pairs(feature)
+        links, jaccs, is_nan = build_pair_vectors(in_col, feature)
+        assert nan_eq(links, lp)
+        assert nan_eq(jaccs, jp)
+        assert np.all(is_nan == (np.isnan(lp) | np.isnan(jp)))
+        assert np.allclose(calc_ratios(links[~is_nan], jaccs[~is_nan]),
+                           calc_ratios(lp, jp))
+    with pytest.raises(ValueError):
+        build_pair_vectors([0, 1, 1], [0, 1])
+
+
+def test_link_table_int_ids():
+    # Integer series ids give the same links as float.
+    in_col = np.array([0, 1, 1, 2, 3, 3, 3, 4])
+    assert np.all(link_table(in_col) == link_table(in_col.astype(float)))
+    assert np.all(link_table(in_col) == equal_to(in_col))
+    # Many distinct ids, needing labels larger than uint8.
+    in_col = np.repeat(np.arange(300) * 0.5, 2)
+    assert np.all(link_table(in_col) == equal_to(in_col))
+
+
+def test_empty():
+    # Empty and single case give no pairs.
+    for in_col in ([], [1]):
+        assert link_pairs(in_col).shape == (0,)
+        assert jaccard_pairs(in_col).shape == (0,)
+        n = len(in_col)
+        assert link_table(in_col).shape == (n, n)
+        assert jaccard_table(in_col).shape == (n, n)
+
+
+def test_count_ratios():
+    for in_col, feature in (
+        ([0, 1, 1, 2, 3, 3, 3, 4], [0, 0, 1, 0, 1, 1, 1, 0]),
+        ([0, 1, 1, 2, 3, np.nan, 3, 4], [0, 0, 1, 0, 1, 1, 1, 0]),
+        ([0, 1, 1, 2, 3, np.nan, 3, 4], [0, np.nan, 1, 0, 1, np.nan, 1, 0]),
+        ([0, 0, 0, 1, 2], [1, 1, 0, 0, 1])):
+        assert np.allclose(count_ratios(in_col, feature),
+                           calc_ratios(link_pairs(in_col),
+                                       jaccard_pairs(feature)))
+    rng = np.random.default_rng(42)
+    in_col = rng.integers(0, 30, size=200).astype(float)
+    in_col[rng.random(200) < 0.1] = np.nan
+    feature = rng.integers(0, 2, size=200).astype(float)
+    feature[rng.random(200) < 0.1] = np.nan
+    assert np.allclose(count_ratios(in_col, feature),
+                       calc_ratios(link_pairs(in_col),
+                                   jaccard_pairs(feature)))
+    with pytest.raises(ValueError):
+        count_ratios([0, 1, 1], [0, 2, 1])
+    with pytest.raises(ValueError):
+        count_ratios([0, 1, 1], [0, 1])
+    with pytest.raises(ValueError):
+        count_ratios([0, np.nan, 1], [0, 1])
+
+
+def test_jaccard_table_out():
+    for feature in ([0, 0, 1, 0, 1, 1, 1, 0],
+                    [0, np.nan, 1, 0, 1, np.nan, 1, 0]):
+        n = len(feature)
+        out = np.empty((n, n), dtype=np.float32)
+        res = jaccard_table(feature, out=out)
+        assert res is out
+        assert nan_eq(out, both_1(feature))
+    feature = [0, 0, 1, 0, 1, 1, 1, 0]
+    res = jaccard_table_u8(feature)
+    assert res.dtype == np.uint8
+    assert np.all(res == both_1(feature))
+    with pytest.raises(ValueError):
+        jaccard_table_u8([0, np.nan, 1])
+
+
+def test_jaccard_pairs_large():
+    # Large enough to use numba kernel, if available.
+    rng = np.random.default_rng(7)
+    feature = rng.integers(0, 2, size=1200).astype(float)
+    feature[rng.random(1200) < 0.1] = np.nan
+    assert nan_eq(jaccard_pairs(feature),
+                  jaccard_table(feature)[np.tril_indices(1200, -1)])
+
+
+def test_pairs_int_ids():
+    # Integer ids too large to compare exactly as float64.
+    big = 2 ** 53
+    in_col = np.array([big, big, big + 1, 5])
+    feature = [1, 1, 1, 0]
+    inds = np.tril_indices(4, -1)
+    lp = link_pairs(in_col)
+    assert np.all(lp == link_table(in_col)[inds])
+    assert np.all(lp == [1, 0, 0, 0, 0, 0])
+    jl_r, jnl_r = count_ratios(in_col, feature)
+    assert np.isclose(jl_r, 1)
+    assert np.isclose(jnl_r, 2 / 5)
+    assert np.allclose((jl_r, jnl_r),
+                       calc_ratios(lp, jaccard_pairs(feature)))